@@ -6,6 +6,7 @@ import logging
 import sys
 from pathlib import Path
 
+import boto3
 import httpx
 import yaml
 from hypha_rpc import connect_to_server
@@ -43,6 +44,18 @@ SERVER_URL = "https://hypha.aicell.io"
 COLLECTION_YAML_URL = "https://raw.githubusercontent.com/imodpasteur/shareloc-collection/refs/heads/gh-pages/collection.yaml"
 DEFAULT_TIMEOUT = 20
 CONCURENT_TASKS = 10
+# Files larger than this are copied in parallel byte ranges via a multipart upload
+MULTIPART_THRESHOLD = 100 * 1024 * 1024
+MULTIPART_PART_SIZE = 64 * 1024 * 1024
+MULTIPART_MAX_PARTS = 10000  # S3 limit on the number of parts per upload
+# Parts of a file copied at once; each part is streamed from the range GET into
+# its PUT, so memory per part is a transfer buffer rather than the part itself
+CONCURENT_PARTS = 4
+# Presigned part URLs are issued up front, so their lifetime grows with the
+# number of rounds of CONCURENT_PARTS parts needed to get through the file
+MULTIPART_EXPIRES_IN = 3600
+MULTIPART_EXPIRES_IN_PER_ROUND = 600
+MULTIPART_MAX_EXPIRES_IN = 7 * 24 * 3600  # S3 limit for presigned URLs
 
 logging.basicConfig(stream=sys.stdout)
 logger = logging.getLogger("artifact")
@@ -86,7 +99,147 @@ async def download_file(url, dest_path, max_retries=5, retry_delay=5):
     logger.error(f"Failed to download {url} after {max_retries} retries.")
     return False
 
-async def upload_file(artifact_manager, artifact_id, base_url, file_path, file_keys, max_retries=5, retry_delay=5, download_weight=0):
+class RangeNotSupported(Exception):
+    """The source cannot serve the file as byte ranges of the expected size."""
+
+
+async def probe_range_support(client, file_url, file_size, max_retries, retry_delay):
+    """Check with a one-byte range request that the source serves ranges of a file of file_size bytes."""
+    retries = 0
+    while retries < max_retries:
+        try:
+            async with client.stream("GET", file_url, headers={"Range": "bytes=0-0"}) as response:
+                if response.status_code == 429:  # Too Many Requests
+                    logger.warning(f"Rate limit hit for {file_url}, retrying after {retry_delay} seconds...")
+                    await asyncio.sleep(retry_delay)
+                elif response.status_code != 206:
+                    raise RangeNotSupported(f"range request returned status code {response.status_code}")
+                elif response.headers.get("Content-Range") != f"bytes 0-0/{file_size}":
+                    raise RangeNotSupported(f"unexpected Content-Range '{response.headers.get('Content-Range')}' for a file of {file_size} bytes")
+                else:
+                    return
+        except RangeNotSupported:
+            raise
+        except Exception as e:
+            logger.warning(f"Error probing range support of {file_url}: {e}")
+        retries += 1
+        if retries < max_retries:
+            await asyncio.sleep(retry_delay * retries)  # Exponential backoff
+    raise RuntimeError(f"Failed to probe range support of {file_url} after {max_retries} retries.")
+
+
+def abort_multipart_upload(upload_id):
+    """Abort an unfinished multipart upload so its uploaded parts don't linger in the bucket."""
+    s3_client = boto3.client(
+        "s3",
+        endpoint_url=os.environ.get("S3_ENDPOINT_URL"),
+        aws_access_key_id=os.environ.get("S3_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.environ.get("S3_SECRET_ACCESS_KEY"),
+        region_name=os.environ.get("S3_REGION_NAME"),
+    )
+    bucket = os.environ.get("S3_BUCKET")
+    # The object key contains the artifact's internal id and version index, which the
+    # artifact manager doesn't expose, so the upload has to be looked up by its id
+    paginator = s3_client.get_paginator("list_multipart_uploads")
+    for page in paginator.paginate(Bucket=bucket, Prefix=os.environ.get("S3_PREFIX") or ""):
+        for upload in page.get("Uploads", []):
+            if upload["UploadId"] == upload_id:
+                s3_client.abort_multipart_upload(Bucket=bucket, Key=upload["Key"], UploadId=upload_id)
+                return True
+    return False
+
+
+async def upload_part(client, file_url, file_size, part, start, end, max_retries, retry_delay):
+    """Stream one byte range of a file to a presigned part URL, retrying only this part."""
+    part_number = part["part_number"]
+    retries = 0
+    while retries < max_retries:
+        try:
+            async with client.stream("GET", file_url, headers={"Range": f"bytes={start}-{end}"}) as response:
+                if response.status_code == 429:  # Too Many Requests
+                    logger.warning(f"Rate limit hit for {file_url}, retrying after {retry_delay} seconds...")
+                    await asyncio.sleep(retry_delay)
+                elif response.status_code != 206:
+                    raise RuntimeError(f"range request bytes={start}-{end} returned status code {response.status_code}")
+                elif response.headers.get("Content-Range") != f"bytes {start}-{end}/{file_size}":
+                    # The source file no longer matches the listed size, retrying won't help
+                    raise ValueError(f"unexpected Content-Range '{response.headers.get('Content-Range')}' for bytes {start}-{end}/{file_size}")
+                else:
+                    upload_response = await client.put(
+                        part["url"],
+                        content=response.aiter_bytes(),
+                        headers={"Content-Length": str(end - start + 1)},
+                    )
+                    if upload_response.status_code != 200:
+                        raise RuntimeError(f"part upload returned status code {upload_response.status_code}, {upload_response.text}")
+                    return {"part_number": part_number, "etag": upload_response.headers["ETag"]}
+        except ValueError:
+            raise
+        except Exception as e:
+            logger.warning(f"Error copying part {part_number} of {file_url}: {e}")
+        retries += 1
+        if retries < max_retries:
+            await asyncio.sleep(retry_delay * retries)  # Exponential backoff
+    raise RuntimeError(f"Failed to copy part {part_number} of {file_url} after {max_retries} retries.")
+
+
+async def upload_file_multipart(artifact_manager, artifact_id, file_url, file_path, file_size, max_retries, retry_delay, download_weight):
+    """Copy a large file as parallel byte ranges pushed into a multipart upload.
+
+    Raises RangeNotSupported before anything is uploaded if the source can't serve
+    ranges of file_size bytes; any later failure aborts the multipart upload.
+    """
+    part_size = max(MULTIPART_PART_SIZE, -(-file_size // MULTIPART_MAX_PARTS))
+    part_count = -(-file_size // part_size)
+    rounds = -(-part_count // CONCURENT_PARTS)
+    expires_in = min(MULTIPART_EXPIRES_IN + rounds * MULTIPART_EXPIRES_IN_PER_ROUND, MULTIPART_MAX_EXPIRES_IN)
+    semaphore = asyncio.Semaphore(CONCURENT_PARTS)
+
+    async def copy_part(client, part):
+        start = (part["part_number"] - 1) * part_size
+        end = min(start + part_size, file_size) - 1
+        async with semaphore:
+            return await upload_part(client, file_url, file_size, part, start, end, max_retries, retry_delay)
+
+    async with httpx.AsyncClient(timeout=DEFAULT_TIMEOUT, follow_redirects=True) as client:
+        await probe_range_support(client, file_url, file_size, max_retries, retry_delay)
+        multipart = await artifact_manager.put_file_start_multipart(
+            artifact_id=artifact_id,
+            file_path=file_path,
+            part_count=part_count,
+            download_weight=download_weight,
+            expires_in=expires_in,
+        )
+        upload_id = multipart["upload_id"]
+        try:
+            tasks = [asyncio.ensure_future(copy_part(client, part)) for part in multipart["parts"]]
+            try:
+                parts = await asyncio.gather(*tasks)
+            finally:
+                # A failing part cancels the remaining ones before the upload is aborted
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            await artifact_manager.put_file_complete_multipart(
+                artifact_id=artifact_id,
+                upload_id=upload_id,
+                parts=parts,
+            )
+        except asyncio.CancelledError:
+            logger.warning(f"Copy of {artifact_id}: {file_path} cancelled, multipart upload {upload_id} left unfinished")
+            raise
+        except Exception:
+            try:
+                loop = asyncio.get_running_loop()
+                if not await loop.run_in_executor(None, abort_multipart_upload, upload_id):
+                    logger.warning(f"Multipart upload {upload_id} for {artifact_id}: {file_path} not found, nothing to abort")
+            except Exception as abort_error:
+                logger.error(f"Failed to abort multipart upload {upload_id} for {artifact_id}: {file_path}: {abort_error}")
+            raise
+    logger.info(f"Uploaded {artifact_id}: {file_path} in {part_count} parts")
+
+
+async def upload_file(artifact_manager, artifact_id, base_url, file_path, file_keys, max_retries=5, retry_delay=5, download_weight=0, file_sizes=None):
     """Modified upload_file function to include retry logic."""
     file_path = file_path.lstrip("./")
     if file_path not in file_keys:
@@ -103,6 +256,16 @@ async def upload_file(artifact_manager, artifact_id, base_url, file_path, file_k
         return
     except Exception:
         logger.info(f"Uploading {file_path} from {file_url}")
+    file_size = (file_sizes or {}).get(file_path) or 0
+    if file_size > MULTIPART_THRESHOLD:
+        try:
+            await upload_file_multipart(artifact_manager, artifact_id, file_url, file_path, file_size, max_retries, retry_delay, download_weight)
+            return
+        except RangeNotSupported as e:
+            logger.warning(f"Cannot copy {artifact_id}: {file_path} in parts, falling back to a single stream: {e}")
+        except Exception as e:
+            logger.error(f"Failed to upload {artifact_id}: {file_path} in parts: {e}")
+            return
     put_url = await artifact_manager.put_file(
         artifact_id=artifact_id,
         file_path=file_path,
@@ -147,21 +310,22 @@ async def upload_files(artifact_manager, artifact_id, base_url, documentation, c
         data = response.json()
         entries = data['entries']
         file_keys = [entry['key'] for entry in entries]
+        file_sizes = {entry['key']: entry.get('size') for entry in entries}
 
     # Upload README
     if documentation:
-        await upload_file(artifact_manager, artifact_id, base_url, documentation, file_keys)
+        await upload_file(artifact_manager, artifact_id, base_url, documentation, file_keys, file_sizes=file_sizes)
 
     # Upload cover images
     for cover in covers:
-        await upload_file(artifact_manager, artifact_id, base_url, cover, file_keys)
+        await upload_file(artifact_manager, artifact_id, base_url, cover, file_keys, file_sizes=file_sizes)
 
     # Upload samples
     for sample in attachments.get('samples', []):
         sample_name = sample.get('name')
         for file_info in sample.get('files', []):
             file = f"{sample_name}/{file_info['name']}"
-            await upload_file(artifact_manager, artifact_id, base_url, file, file_keys)
+            await upload_file(artifact_manager, artifact_id, base_url, file, file_keys, file_sizes=file_sizes)
 
     logger.info(f"Uploaded all files for {artifact_id}")
 
@@ -184,6 +348,8 @@ async def migrate_collection(skip_migrated):
     assert os.environ.get("S3_ENDPOINT_URL"), "S3_ENDPOINT_URL is not set"
     assert os.environ.get("S3_ACCESS_KEY_ID"), "S3_ACCESS_KEY_ID is not set"
     assert os.environ.get("S3_SECRET_ACCESS_KEY"), "S3_SECRET_ACCESS_KEY is not set"
+    assert os.environ.get("S3_BUCKET"), "S3_BUCKET is not set"
+    assert os.environ.get("S3_PREFIX"), "S3_PREFIX is not set"
     assert os.environ.get("SANDBOX_ZENODO_ACCESS_TOKEN"), "SANDBOX_ZENODO_ACCESS_TOKEN is not set"
     assert os.environ.get("ZENODO_ACCESS_TOKEN"), "ZENODO_ACCESS_TOKEN is not set"
     